@@ -1,6 +1,7 @@
 from datetime import date
+from os.path import basename
 from fastapi import HTTPException
-import requests
+from app.archives.CTAN_mirrors import mirror_pool
 from app.helpers import helpers
 
 from app.schemas import Package
@@ -9,17 +10,14 @@ logger = helpers.make_logger('api_get_packages')
 
 
 def download_pkg(pkg: Package) -> bytes:
-    logger.info(f"CTAN: Downloading {pkg} {date}")
+    logger.info("CTAN: Downloading %s %s", pkg, date)
 
-    # Extract download path
+    # Extract download path, relative to root of a CTAN mirror
     if pkg.install:
-        path = pkg.install
-        url = "https://mirror.ctan.org/install" + path  # Should end in .zip or similar
+        path = "/install" + pkg.install  # Should end in .zip or similar
 
     elif pkg.ctan:
-        path = pkg.ctan.path
-        # url = f"https://mirror.ctan.org/tex-archive{path}{'' if '.' in path else '.zip' }"
-        url = f"https://mirror.ctan.org{path}{'' if '.' in path else '.zip' }"
+        path = f"{pkg.ctan.path}{'' if '.' in pkg.ctan.path else '.zip' }"
     else:
         if pkg.id:
             raise HTTPException(status_code=400, detail={
@@ -28,13 +26,10 @@ def download_pkg(pkg: Package) -> bytes:
             })
         raise HTTPException(status_code=400, detail={'reason': f"{pkg.id} not available on CTAN", 'CTAN_response': pkg})
 
-    logger.debug(f"CTAN download-url is {url}")
+    logger.debug("CTAN download-path is %s", path)
 
-    if url.endswith('.zip'):
-        response = requests.get(url, allow_redirects=True)
-        if not response.ok:
-            raise HTTPException(400, response.reason)
-
-        return response.content
+    content = mirror_pool.download(path)
+    if path.endswith('.zip'):
+        return content
     else:
-        return helpers.download_files_to_binary_zip([url], pkg.id)
+        return helpers.files_to_binary_zip({basename(path): content})
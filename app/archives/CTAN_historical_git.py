@@ -1,13 +1,15 @@
+from contextlib import contextmanager
 import datetime
-from typing import Optional
+import threading
+from typing import Optional, TypedDict
 from app.archives.IArchive import IArchive
-from app.helpers import helpers
+from app.helpers import helpers, profiling
 from app.schemas import Package
 
 from dateutil import parser
 import logging
 import os
-from os.path import join, isdir, isfile, basename, exists
+from os.path import join, isfile, basename, exists
 import subprocess
 import requests
 import json
@@ -15,6 +17,17 @@ from bs4 import BeautifulSoup as bs4
 from urllib.parse import urljoin
 from collections import defaultdict
 
+try:
+    import fcntl
+except ImportError:  # Windows: No locking between processes
+    fcntl = None
+
+
+class IndexUpdate(TypedDict):
+    published: bool  # Whether a new index was published
+    added: int  # Number of commits added
+    failed_commits: "list[str]"  # Commits whose indexing failed
+
 
 class CTAN_historical_git(IArchive):
     def __init__(self, ctan_archive_path='CTAN') -> None:
@@ -22,79 +35,111 @@ class CTAN_historical_git(IArchive):
         # self._ctan_path = Path(ctan_archive_path)
         self._pkg_info_file = "CTAN_packages.json"
         self._index_file = "CTAN_Archive_index.json"
+        self._index_file_stat = None  # (mtime, inode) of index file when it was last read or written
+        self._reload_lock = threading.Lock()
         self._pkg_infos = self._get_pkg_infos()
+        self._pkgs_by_path = self._build_path_index()
         self._index = self._read_index_file()
         self._index_logger = helpers.make_logger(name='CTANArchive')
         self._download_logger = helpers.make_logger(name='api_get_packages')
 
-    def update_index(self, inspect_every_nth_commit: int = 7):
-        self._index_logger.info("Updating index")
-        old_cwd = os.getcwd()
-        os.chdir(self._ctan_path)
+    def update_index(self, inspect_every_nth_commit: int = 7, profile_commit: Optional[str] = None) -> "IndexUpdate":
+        """Indexes all new commits of the archive into a new generation of the index, \
+            then publishes it to the index file and to readers. \
+            If profile_commit is one of the new commits, it is always inspected and indexing it is profiled. \
+            Raises if the archive can't be read or another process is updating the index"""
+        with self._index_update_lock():
+            self._index_logger.info("Updating index")
+            # Another process may have published a newer index since we read it
+            self._reload_index_if_changed()
+            # Build into a copy, so readers never see a half-built index. Entries of old commits are never changed
+            new_index = defaultdict(lambda: defaultdict(dict))
+            new_index.update(self._index)
+            failed_commits = []
 
-        try:
             # Checkout master (Restores HEAD to latest commit, otherwise getting list of all commits not possible)
-            curr_branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD']).decode().strip()
+            curr_branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'],
+                                                  cwd=self._ctan_path).decode().strip()
             if curr_branch != 'master':
-                subprocess.call(['git', 'checkout', '--force', 'master'])  # Checkout the commit
+                subprocess.check_call(['git', 'checkout', '--force', 'master'], cwd=self._ctan_path)
 
-            # TODO: Pull latest changes here
+            # Get new commits. If that fails (e.g. no network), still index the ones we have
+            pull = subprocess.run(['git', 'pull', '--ff-only'], cwd=self._ctan_path,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if pull.returncode != 0:
+                self._index_logger.warning("Could not pull latest changes of the archive: %s",
+                                           pull.stderr.decode().strip())
 
             commit_hashes = subprocess.check_output(
                 ['git', 'rev-list', 'HEAD'], cwd=self._ctan_path).decode().splitlines()
-            indexed_commit_hashes = [hash for hash in self._index.keys()]
 
             # Only build index for hashes which are not yet in index
-            hashes_to_index = [hash for hash in commit_hashes if hash not in indexed_commit_hashes]
+            hashes_to_index = [hash for hash in commit_hashes if hash not in new_index]
 
             if len(hashes_to_index) == 0:
                 self._index_logger.info("Index is already up-to-date")
-                os.chdir(old_cwd)
-                return
-            self._index_logger.info(f"Adding {len(hashes_to_index)} hashes to index: {hashes_to_index}")
-
-            for i, commit_hash in enumerate(hashes_to_index):
-                # For every n-th commit, ...
-                if i % inspect_every_nth_commit == 0:
-                    subprocess.call(['git', 'stash'])  # stash any changes,
-                    subprocess.call(['git', 'checkout', '--force', commit_hash])  # checkout the commit and
-                    try:
-                        self._build_index_for_hash(commit_hash)  # Build the index for current hash
-                    except Exception as e:
-                        self._index_logger.error(f"unexpected error at commit {commit_hash}: {e}")
-                        logging.exception(e)
-                else:
-                    self._index[commit_hash] = None
-                    self._index_logger.info(f"Skipping commit {commit_hash}")
+                return {'published': False, 'added': 0, 'failed_commits': []}
+            self._index_logger.info("Adding %d hashes to index: %s", len(hashes_to_index), hashes_to_index)
+            if profile_commit and profile_commit not in hashes_to_index:
+                self._index_logger.warning("Not profiling %s, it is not a new commit", profile_commit)
+
+            try:
+                for i, commit_hash in enumerate(hashes_to_index):
+                    # For every n-th commit, ...
+                    if i % inspect_every_nth_commit == 0 or commit_hash == profile_commit:
+                        subprocess.call(['git', 'stash'], cwd=self._ctan_path)  # stash any changes,
+                        # checkout the commit and
+                        subprocess.call(['git', 'checkout', '--force', commit_hash], cwd=self._ctan_path)
+                        try:
+                            if commit_hash == profile_commit:
+                                with profiling.Profile(f"build_index-{commit_hash}"):
+                                    self._build_index_for_hash(commit_hash, new_index)
+                            else:
+                                self._build_index_for_hash(commit_hash, new_index)  # Build the index for current hash
+                        except Exception as e:
+                            # Keep going, one broken commit shouldn't stop the whole update
+                            self._index_logger.error("unexpected error at commit %s: %s", commit_hash, e)
+                            logging.exception(e)
+                            failed_commits.append(commit_hash)
+                    else:
+                        new_index[commit_hash] = None
+                        self._index_logger.info("Skipping commit %s", commit_hash)
+            finally:
+                # Leave the clone on master, so it can be pulled (also from outside) and the next update starts there
+                if subprocess.call(['git', 'checkout', '--force', 'master'], cwd=self._ctan_path) != 0:
+                    self._index_logger.error("Could not check out master of the archive again")
 
             self._index_logger.info("All commit-hashes done")
 
-        except Exception as e:
-            self._index_logger.error(str(e))
-            logging.exception(e)
-
-        os.chdir(old_cwd)
-        self._write_index_to_file()
+            self._write_index_to_file(new_index)
+            # Publish new generation. Replacing the reference is atomic, readers hold on to the one they started with
+            added = len(new_index) - len(self._index)
+            self._index = new_index
+            return {'published': True, 'added': added, 'failed_commits': failed_commits}
 
     def get_commit_hash(self, pkg: Package, closest: bool) -> Optional[str]:
         """Get commit hash at which pkg has the correct version in git archive"""
         all_versions = []
+        self._reload_index_if_changed()
+        index = self._index  # Index can be swapped by indexer while we read it
 
-        for hash in self._index:
-            if not self._index[hash] or not self._index[hash][pkg.id]:
+        for hash in index:
+            # Use .get(): Reading a missing key would insert it into the defaultdict
+            if not index[hash] or not index[hash].get(pkg.id):
                 continue
-            files = self._index[hash][pkg.id]
+            files = index[hash][pkg.id]
             if 'Error' in files.keys():
                 continue
             if len(files) != 1:
-                self._index_logger.info(f"{pkg.id} has {len(files)} files with a version: {files.values()}. Returning first one")  # noqa: E501
+                self._index_logger.info("%s has %d files with a version: %s. Returning first one",
+                                        pkg.id, len(files), files.values())
             if closest:
                 all_versions.append({hash: files})
                 continue
 
             for version in files.values():
                 if helpers.version_matches(version, pkg.version):
-                    self._index_logger.info(f"{pkg.id} has version {pkg.version} at commit {hash}")
+                    self._index_logger.info("%s has version %s at commit %s", pkg.id, pkg.version, hash)
                     return hash
 
         if closest and all_versions and pkg.version.date:
@@ -115,7 +160,7 @@ class CTAN_historical_git(IArchive):
             later_versions = filter(lambda pair: pair[next(iter(pair))] >= req_date, all_versions_clean)
             closest_later = min(later_versions, key=lambda pair: pair[next(iter(pair))])
 
-            self._download_logger.info(f"For {pkg.id}({pkg.version.date}): Closest version is {closest_later}")
+            self._download_logger.info("For %s(%s): Closest version is %s", pkg.id, pkg.version.date, closest_later)
             return next(iter(closest_later))
         return None
 
@@ -125,13 +170,13 @@ class CTAN_historical_git(IArchive):
     def _get_pkg_infos(self):
         # ASSUMPTION: Every package's files are stored in a folder with pkg_name
         if not exists(self._pkg_info_file):
-            all = requests.get("http://www.ctan.org/json/2.0/packages").json()
+            all = requests.get(f"{helpers.ctan_url}/json/2.0/packages").json()
 
             res = []
             for pkg in all:
                 pkg_id = pkg['key']
 
-                pkgInfo_res = requests.get(f"https://www.ctan.org/json/2.0/pkg/{pkg_id}")
+                pkgInfo_res = requests.get(f"{helpers.ctan_url}/json/2.0/pkg/{pkg_id}")
                 if not pkgInfo_res.ok:
                     print(f"{pkg['name']} not on CTAN")
                     continue
@@ -147,6 +192,55 @@ class CTAN_historical_git(IArchive):
 
         return res
 
+    def _build_path_index(self) -> "dict[str, list[Package]]":
+        """Maps each package's ctan path (relative to archive root) to the packages stored there"""
+        pkgs_by_path = defaultdict(list)
+        for pkg in self._pkg_infos:
+            if not pkg.ctan or not pkg.ctan.path:
+                continue
+            pkgs_by_path[pkg.ctan.path.strip('/')].append(pkg)
+        return pkgs_by_path
+
+    def _get_changed_pkgs(self, changed_files: "list[str]") -> "list[tuple[str, Package]]":
+        """Returns (path, pkg) for every package whose ctan path is a changed file or an ancestor dir of one"""
+        changed = {}
+        for file in changed_files:
+            parts = file.strip('/').split('/')
+            # Check the file itself and every directory above it
+            for i in range(len(parts), 0, -1):
+                path = '/'.join(parts[:i])
+                for pkg in self._pkgs_by_path.get(path, ()):
+                    changed[pkg.id] = (path, pkg)
+        return list(changed.values())
+
+    @contextmanager
+    def _index_update_lock(self):
+        """Makes sure only one process at a time checks out commits and writes the index"""
+        with open(self._index_file + '.lock', 'w') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise RuntimeError("Index is already being updated by another process")
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _reload_index_if_changed(self):
+        """Reads index file again if another process (e.g. another API worker) has published a new one"""
+        try:
+            stat = os.stat(self._index_file)
+        except FileNotFoundError:
+            return
+        if (stat.st_mtime_ns, stat.st_ino) == self._index_file_stat:
+            return
+
+        with self._reload_lock:
+            if (stat.st_mtime_ns, stat.st_ino) != self._index_file_stat:
+                self._index = self._read_index_file()
+
     def _read_index_file(self):
         def defaultdict_from_dict(d):
             nd = lambda: defaultdict(nd)  # noqa: E731
@@ -154,71 +248,77 @@ class CTAN_historical_git(IArchive):
             ni.update(d)
             return ni
 
-        if exists(self._index_file):
-            with open(self._index_file, 'r') as f:
-                return json.load(f, object_hook=defaultdict_from_dict)
-        else:
+        if not exists(self._index_file):
             with open(self._index_file, 'w') as f:
                 json.dump({}, f)
-            return defaultdict(lambda: defaultdict(dict))
 
-    def _write_index_to_file(self):
+        with open(self._index_file, 'r') as f:
+            # Stat of the opened file, in case it's replaced while we read it
+            stat = os.fstat(f.fileno())
+            index = json.load(f, object_hook=defaultdict_from_dict)
+        self._index_file_stat = (stat.st_mtime_ns, stat.st_ino)
+        return index
+
+    def _write_index_to_file(self, index: dict):
+        """Writes index to a temporary file first and renames it, so the index file is never half-written"""
+        tmp_file = f"{self._index_file}.{os.getpid()}.tmp"
         try:
-            with open(self._index_file, "w") as indexf:
-                json.dump(self._index, indexf, indent=2)
+            with open(tmp_file, "w") as indexf:
+                json.dump(index, indexf, indent=2)
 
         except Exception as e:
             logging.exception(e)
             # print(self._index)
-            with open(self._index_file, "w") as indexf:
-                indexf.write(json.dumps(self._index, default=lambda elem: str(elem), indent=2))
+            with open(tmp_file, "w") as indexf:
+                indexf.write(json.dumps(index, default=lambda elem: str(elem), indent=2))
 
+        os.replace(tmp_file, self._index_file)
+        # Our own index, so no need to reload it
+        stat = os.stat(self._index_file)
+        self._index_file_stat = (stat.st_mtime_ns, stat.st_ino)
         self._index_logger.info("Wrote index to file")
 
-    def _build_index_for_hash(self, commit_hash):
+    def _build_index_for_hash(self, commit_hash: str, index: dict):
         """Extracts versions for all packages that changed at 7 \
             or less days before specified commit, write results to index"""
-        curr_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('ascii').strip()
+        curr_hash = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self._ctan_path).decode('ascii').strip()
         if curr_hash != commit_hash:
             raise ValueError(f"Building index for {commit_hash}, but git-repo is at {curr_hash}")
 
         changed_files = helpers.parse_changed_files(self._ctan_path)
-        changed_dirs = set(os.path.split(file)[0] for file in changed_files)
-        self._index_logger.info(f"Building index for {commit_hash}. {len(changed_dirs)} changed dirs")
 
         # Make sure we can write to index at commit hash
-        if not self._index[commit_hash]:
-            self._index[commit_hash] = defaultdict(lambda: defaultdict(dict))
-        for pkg in self._pkg_infos:  # For each package:
-            if not pkg.ctan or not pkg.ctan.path:
-                self._index_logger.debug(f"{pkg.id} has no path on ctan. Skipping")
-                continue
-            pkg.ctan.path = pkg.ctan.path.lstrip(os.path.sep)
-            pkg_dir = join(self._ctan_path, pkg.ctan.path)
+        if not index[commit_hash]:
+            index[commit_hash] = defaultdict(lambda: defaultdict(dict))
 
-            # Skip packages that haven't changed, except for first commit
-            if len(self._index) > 1:
-                if isfile(pkg_dir) and pkg.ctan.path not in changed_files:
-                    self._index_logger.debug(f"{pkg.id} has not changed")
-                    continue
-                if isdir(pkg_dir) and pkg.ctan.path not in changed_dirs:
-                    self._index_logger.debug(f"{pkg.id} has not changed")
-                    continue
+        # Only look at packages that changed, except for first commit
+        if len(index) > 1:
+            pkgs_to_index = self._get_changed_pkgs(changed_files)
+        else:
+            pkgs_to_index = [(pkg.ctan.path.strip('/'), pkg) for pkg in self._pkg_infos if pkg.ctan and pkg.ctan.path]
+        self._index_logger.info("Building index for %s. %d changed files, %d packages to index",
+                                commit_hash, len(changed_files), len(pkgs_to_index))
+        # Per-package outcomes are logged as one summary per commit instead of one record per package
+        missing, no_version = [], []
+        debug = self._index_logger.isEnabledFor(logging.DEBUG)
+
+        for pkg_path, pkg in pkgs_to_index:  # For each package:
+            pkg_dir = join(self._ctan_path, pkg_path)
 
             found = False
 
             if not exists(pkg_dir):
-                self._index_logger.debug(f"{pkg.id} should be at {pkg_dir}, which doesn't exist.")
-                # self._index[commit_hash][pkg.id]["Error"] = f"{pkg.id} should be at {pkg_dir}, which doesn't exist."
+                missing.append(pkg.id)
+                # index[commit_hash][pkg.id]["Error"] = f"{pkg.id} should be at {pkg_dir}, which doesn't exist."
                 continue
 
             # Case where Ctan.path is a file, not a folder
             if isfile(pkg_dir):
                 # pkg.ctan.path can be path to a file (e.g. /biblio/bibtex/contrib/misc/aaai-named.bst for aaai-named):
                 # In this case, only look at that one file
-                found = helpers.extract_version_from_file(pkg_dir, pkg.id, self._index, commit_hash)
+                found = helpers.extract_version_from_file(pkg_dir, pkg.id, index, commit_hash)
                 if not found:
-                    self._index[commit_hash][pkg.id]["Error"] = f"{pkg.id} has path {pkg_dir}, which has no version"
+                    index[commit_hash][pkg.id]["Error"] = f"{pkg.id} has path {pkg_dir}, which has no version"
                 continue
 
             # TODO: Add fallback to glob-search here
@@ -228,7 +328,7 @@ class CTAN_historical_git(IArchive):
 
             # Try to extract versions from pkg_name.sty/.cls
             for file in relevant_files['sty/cls']:
-                found = found or helpers.extract_version_from_file(file, pkg.id, self._index, commit_hash)
+                found = found or helpers.extract_version_from_file(file, pkg.id, index, commit_hash)
 
             if found:
                 continue
@@ -240,13 +340,13 @@ class CTAN_historical_git(IArchive):
                 try:
                     helpers.install_file(ins_file)
                 except Exception as e:
-                    self._index_logger.warning(f'Problem while installing {ins_file}: {e}')
+                    self._index_logger.warning('Problem while installing %s: %s', ins_file, e)
                     continue
 
                 _relevant_files = helpers.get_relevant_files(pkg_dir, pkg, sty_cls=True, ins=False, dtx=False)
                 # Try to extract versions from pkg_name.sty/.cls
                 for file in _relevant_files['sty/cls']:
-                    found = found or helpers.extract_version_from_file(file, pkg.id, self._index, commit_hash)
+                    found = found or helpers.extract_version_from_file(file, pkg.id, index, commit_hash)
 
             # Dont try to install dtx-files if ins-file is present.
             # This can lead to timeout-error for every dtx-file, which can be many (e.g. acrotex)
@@ -258,31 +358,41 @@ class CTAN_historical_git(IArchive):
                 try:
                     helpers.install_file(dtx_file)
                 except Exception as e:
-                    self._index_logger.warning(f'Problem while installing {dtx_file}: {e}')
+                    self._index_logger.warning('Problem while installing %s: %s', dtx_file, e)
                 _relevant_files = helpers.get_relevant_files(pkg_dir, pkg, sty_cls=True, ins=False, dtx=False)
                 # Try to extract versions from pkg_name.sty/.cls
                 for file in _relevant_files['sty/cls']:
-                    found = found or helpers.extract_version_from_file(file, pkg.id, self._index, commit_hash)
+                    found = found or helpers.extract_version_from_file(file, pkg.id, index, commit_hash)
 
             if not found:
-                self._index_logger.info(f'WARNING: Couldnt find any version for {pkg.name}. '
-                                        f'Files: {[basename(file) for file in os.listdir(pkg_dir)]}')
-                self._index[commit_hash][pkg.id]["Error"] = "No version found"
-
-    def get_pkg_files(self, pkg: Package, closest: bool) -> bytes:
-        """Returns zip-file of package's files in byte format"""
+                no_version.append(pkg.name)
+                if debug:
+                    self._index_logger.debug("Couldnt find any version for %s. Files: %s",
+                                             pkg.name, [basename(file) for file in os.listdir(pkg_dir)])
+                index[commit_hash][pkg.id]["Error"] = "No version found"
+
+        if missing:
+            self._index_logger.debug("%d packages don't exist at %s: %s", len(missing), commit_hash, missing)
+        if no_version:
+            self._index_logger.info("WARNING: Couldnt find any version for %d packages at %s, e.g. %s",
+                                    len(no_version), commit_hash, no_version[:10])
+
+    def get_pkg_files(self, pkg: Package, closest: bool, commit_hash: Optional[str] = None) -> bytes:
+        """Returns zip-file of package's files in byte format. \
+            If commit_hash is not given, it is looked up in the index"""
         if not pkg.ctan or not pkg.ctan.path:
             raise NotImplementedError("Can only download packages where I know the ctan path")
 
         # Build url where package files are found
-        base_url = "https://git.texlive.info/CTAN/plain"
-        commit_hash = self.get_commit_hash(pkg, closest)
+        base_url = f"{helpers.ctan_archive_url}/plain"
+        if not commit_hash:
+            commit_hash = self.get_commit_hash(pkg, closest)
         if not commit_hash:
-            self._download_logger.debug(f"{pkg.id} ({pkg.version}) is not in CTAN Archive")
+            self._download_logger.debug("%s (%s) is not in CTAN Archive", pkg.id, pkg.version)
             return False
 
         overview_url = f"{base_url}{pkg.ctan.path}?id={commit_hash}"
-        self._download_logger.info(f"CTAN Archive: Downloading {pkg.id} ({pkg.version}) from {overview_url}")
+        self._download_logger.info("CTAN Archive: Downloading %s (%s) from %s", pkg.id, pkg.version, overview_url)
 
         # Extract download-links for each individual file
         page = requests.get(overview_url)
@@ -292,7 +402,7 @@ class CTAN_historical_git(IArchive):
 
         # FIXME: Some packages follow TDS: Need to expand '/tex' and/or '/latex' to get files
         # Download each file, return as binary zip-file
-        self._download_logger.info(f"Downloading {len(urls)} files from {overview_url}")
+        self._download_logger.info("Downloading %d files from %s", len(urls), overview_url)
         return helpers.download_files_to_binary_zip(urls, pkg.id)
 
 
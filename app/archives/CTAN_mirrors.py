@@ -0,0 +1,170 @@
+import logging
+import os
+from os.path import isdir, isfile, join, normpath
+import threading
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+import requests
+
+from app.helpers import helpers
+
+logger = helpers.make_logger('mirrors')
+
+# Used when no mirrors are configured. Redirects each request to a random mirror
+_redirector_url = "https://mirror.ctan.org"
+
+
+class Mirror:
+    """A CTAN mirror together with what we have seen of its latency and health"""
+
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip('/')
+        self.latency: Optional[float] = None  # Moving average of time until response headers, in seconds
+        self.failures = 0  # Consecutive failures
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def __repr__(self) -> str:
+        return f"Mirror({self.url}, latency={self.latency}, failures={self.failures})"
+
+
+class MirrorPool:
+    """Downloads files from the fastest healthy CTAN mirror, failing over to the next one if a mirror fails. \
+        A local mirror directory, if configured, is always preferred"""
+
+    def __init__(self, urls: "list[str]", local_dir: Optional[str] = None, timeout: float = 10,
+                 probe_interval: float = 300, probe_path: str = "/README") -> None:
+        self.mirrors = [Mirror(url) for url in urls if url.strip()]
+        self.local_dir = normpath(local_dir) if local_dir else None
+        self._timeout = timeout
+        self._probe_interval = probe_interval
+        self._probe_path = probe_path
+        self._lock = threading.Lock()
+        self._probe_thread: Optional[threading.Thread] = None
+
+    def ranked(self) -> "list[Mirror]":
+        """Healthy mirrors by latency (unmeasured ones after measured ones), then unhealthy ones as last resort"""
+        with self._lock:
+            healthy = [m for m in self.mirrors if m.healthy]
+            unhealthy = [m for m in self.mirrors if not m.healthy]
+            healthy.sort(key=lambda m: (m.latency is None, m.latency or 0))
+            unhealthy.sort(key=lambda m: m.unhealthy_until)
+        return healthy + unhealthy
+
+    def download(self, path: str) -> bytes:
+        """Returns content of file at path (relative to CTAN root, e.g. /macros/latex/contrib/foo.zip)"""
+        content = self._read_local(path)
+        if content is not None:
+            return content
+
+        not_found = []
+        for mirror in self.ranked():
+            url = mirror.url + path
+            try:
+                response = requests.get(url, allow_redirects=True, timeout=self._timeout)
+            except requests.RequestException as e:
+                logger.warning("%s failed for %s: %s", mirror.url, path, e)
+                self._record_failure(mirror)
+                continue
+
+            # Score by time until headers arrived, so the size of the download doesn't count against the mirror
+            if response.ok:
+                self._record_success(mirror, _time_to_headers(response))
+                logger.debug("Downloaded %s from %s", path, mirror.url)
+                return response.content
+            if response.status_code == 404:
+                # Mirror works, but might not be up-to-date
+                self._record_success(mirror, _time_to_headers(response))
+                not_found.append(mirror.url)
+                continue
+
+            logger.warning("%s failed for %s: %s %s", mirror.url, path, response.status_code, response.reason)
+            self._record_failure(mirror)
+
+        if not_found and len(not_found) == len(self.mirrors):
+            raise HTTPException(status_code=404, detail=f"{path} not found on any CTAN mirror")
+        raise HTTPException(status_code=502, detail=f"Could not download {path} from any CTAN mirror")
+
+    def probe(self):
+        """Measures latency and health of every mirror once"""
+        for mirror in list(self.mirrors):
+            try:
+                response = requests.head(mirror.url + self._probe_path, allow_redirects=True, timeout=self._timeout)
+                ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+
+            if ok:
+                self._record_success(mirror, _time_to_headers(response))
+            else:
+                self._record_failure(mirror)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Probed mirrors: %s", self.ranked())
+
+    def start_probing(self):
+        """Probes all mirrors every probe_interval seconds in a background thread"""
+        if self._probe_thread or self._probe_interval <= 0:
+            return
+
+        def probe_forever():
+            while True:
+                try:
+                    self.probe()
+                except Exception as e:
+                    logger.error("Probing mirrors failed: %s", e)
+                time.sleep(self._probe_interval)
+
+        self._probe_thread = threading.Thread(target=probe_forever, name='mirror-probe', daemon=True)
+        self._probe_thread.start()
+
+    def _read_local(self, path: str) -> Optional[bytes]:
+        if not self.local_dir:
+            return None
+
+        local_path = normpath(join(self.local_dir, path.lstrip('/')))
+        if not local_path.startswith(self.local_dir + os.path.sep):
+            return None
+        if isfile(local_path):
+            with open(local_path, 'rb') as f:
+                return f.read()
+        # Mirrors serve directories as zip, so build that zip ourselves
+        if local_path.endswith('.zip') and isdir(local_path[:-len('.zip')]):
+            return helpers.dir_to_binary_zip(local_path[:-len('.zip')])
+        return None
+
+    def _record_success(self, mirror: Mirror, latency: float):
+        with self._lock:
+            mirror.latency = latency if mirror.latency is None else 0.7 * mirror.latency + 0.3 * latency
+            mirror.failures = 0
+            mirror.unhealthy_until = 0.0
+
+    def _record_failure(self, mirror: Mirror):
+        with self._lock:
+            mirror.failures += 1
+            # Back off exponentially, up to 10 minutes
+            mirror.unhealthy_until = time.monotonic() + min(5 * 2 ** (mirror.failures - 1), 600)
+
+
+def _time_to_headers(response: requests.Response) -> float:
+    """Seconds until headers arrived, including redirects"""
+    return sum(r.elapsed.total_seconds() for r in [*response.history, response])
+
+
+def _pool_from_env() -> MirrorPool:
+    urls = os.environ.get('VPTAN_CTAN_MIRRORS', _redirector_url).split(',')
+    return MirrorPool(
+        urls,
+        local_dir=os.environ.get('VPTAN_CTAN_LOCAL_MIRROR'),
+        timeout=float(os.environ.get('VPTAN_MIRROR_TIMEOUT', 10)),
+        probe_interval=float(os.environ.get('VPTAN_MIRROR_PROBE_INTERVAL', 300))
+    )
+
+
+mirror_pool = _pool_from_env()
+if len(mirror_pool.mirrors) > 1:
+    mirror_pool.start_probing()
@@ -1,10 +1,14 @@
 from datetime import date
+import hmac
+import os
 import re
+import time
 from typing import Optional, Union
 from dateutil import parser
 import requests
-from fastapi import HTTPException, status
+from fastapi import Header, HTTPException, status
 
+from app.helpers import helpers, profiling
 from app.schemas import Package
 
 
@@ -12,7 +16,7 @@ async def pkg_id_exists(pkg_id: str) -> Package:
     """ Returns Package object for pkg_id which are valid according to CTAN, \
         i.e. where querying https://www.ctan.org/json/2.0/pkg/{pkg_id} will be successful
         Note: Some packages have aliases. pkg_id must be the package that aliases the package whose files you want"""
-    url = f"https://www.ctan.org/json/2.0/pkg/{pkg_id}"
+    url = f"{helpers.ctan_url}/json/2.0/pkg/{pkg_id}"
     res = requests.get(url)
     if res.ok:
         data = res.json()
@@ -41,3 +45,26 @@ def valid_date(date: Union[str, None] = None) -> Optional[date]:
         print('date not valid')
 
     raise HTTPException(status_code=400, detail=f"Cannot parse provided date: {date}")
+
+
+def admin_authorized(x_admin_token: Union[str, None] = Header(default=None)) -> None:
+    """Only lets requests through whose X-Admin-Token header matches VPTAN_ADMIN_TOKEN. \
+        If VPTAN_ADMIN_TOKEN is not set, nobody is authorized"""
+    admin_token = os.environ.get('VPTAN_ADMIN_TOKEN')
+    if not admin_token:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin endpoints are disabled")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid X-Admin-Token")
+
+
+async def profiling_requested(x_profile: Union[str, None] = Header(default=None),
+                              x_admin_token: Union[str, None] = Header(default=None)) -> Optional[float]:
+    """If request should be profiled (VPTAN_PROFILE is set, or request has header X-Profile: 1 \
+        and is authorized as admin), returns time.perf_counter() at which profiling started, otherwise None. \
+        Must come before the other dependencies of the endpoint, so their time (asking CTAN about the package) \
+        is counted in the total"""
+    if not profiling.profile_requests:
+        if x_profile != '1':
+            return None
+        admin_authorized(x_admin_token)
+    return time.perf_counter()
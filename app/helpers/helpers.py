@@ -1,25 +1,55 @@
+import atexit
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+import gzip
 import io
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import lzma
 import os
 from os.path import abspath, basename, join
+import queue
 import re
 import subprocess
 import sys
+import tarfile
 import zipfile
-from typing import TypedDict
+from typing import Callable, TypedDict
 from dateutil import parser
 
+from fastapi import HTTPException
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from app.helpers import helpers
 
 from app.schemas import Package, Version
 
+# Upstream servers. Configurable, e.g. to point at local stand-ins for load tests
+ctan_url = os.environ.get('VPTAN_CTAN_URL', "https://www.ctan.org").rstrip('/')
+ctan_archive_url = os.environ.get('VPTAN_CTAN_ARCHIVE_URL', "https://git.texlive.info/CTAN").rstrip('/')
+
 # TODO: Test these new Regexes
 provides_pattern = r'\\Provides(?:Package|File|Class)\s*\{(?P<name>.*?)\}\s*(?:\[(?P<version>[\S\s]*?)\])?'
 provides_expl_pattern = r'\\ProvidesExplPackage\s*\{(?P<name>.*?)\}\s*\{(?P<version>.*?\}\s*\{.*?)\}\s*\{(.*?)\}'
 
+# Timestamp for all files in zips we build, so that the same files always result in the same bytes
+_zip_date_time = (1980, 1, 1, 0, 0, 0)
+
+# Compression of archives we build, and size of the blocks that large archives are compressed in parallel
+_default_compresslevel = 6
+_parallel_block_size = 1 << 20
+# xz presets above 6 need several times the memory per block for little gain, so higher levels use 6
+_max_xz_preset = 6
+# Shared by all requests, so compressing uses at most one thread per core however many requests there are
+# zlib and lzma release the GIL while compressing, so threads are enough
+_compress_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='compress')
+
+# (connect, read) timeout and retries for downloading single files
+_download_timeout = (5, 30)
+_download_retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+
 
 class VersionFromIndex(TypedDict):
     raw: str
@@ -70,7 +100,7 @@ def parse_version(version: str) -> VersionFromIndex:
             try:
                 date = parser.parse(version, fuzzy=True, dayfirst=True).date()
             except Exception as e:
-                print(f"Cannot parse {version}: {e}")
+                logger.debug("Cannot parse %s: %s", version, e)
                 date = None
 
         return {'raw': version, 'date': date, 'number': number}
@@ -88,47 +118,115 @@ def parse_changed_files(path_to_ctan: str) -> "list[str]":
 
 
 def download_files_to_binary_zip(file_urls: "list[str]", pkg_id: str) -> bytes:
-    s = io.BytesIO()
-    zf = zipfile.ZipFile(file=s, mode="w")
+    files = {}
+    # Session reuses the connection for all files, and retries files that fail temporarily
+    with requests.Session() as session:
+        session.mount('https://', HTTPAdapter(max_retries=_download_retries))
+        session.mount('http://', HTTPAdapter(max_retries=_download_retries))
+
+        for url in file_urls:
+            # Calculate path for file in zip
+            fname = os.path.basename(url).split('?')[0]
+            if not fname:  # E.g. hyperref, which has /doc folder
+                continue
 
-    for url in file_urls:
-        # Calculate path for file in zip
-        fname = os.path.basename(url).split('?')[0]
-        if not fname:  # E.g. hyperref, which has /doc folder
-            continue
+            try:
+                resp = session.get(url, timeout=_download_timeout)
+            except requests.RequestException as e:
+                raise HTTPException(status_code=502, detail=f"Couldnt get file at {url}: {e}")
+            if not resp.ok:
+                raise HTTPException(status_code=502, detail=f"Couldnt get file at {url}: {resp.status_code}")
 
-        resp = requests.get(url)
-        if not resp.ok:
-            raise RuntimeError("Couldnt get file at " + url)
+            files[fname] = resp.content
 
+    return files_to_binary_zip(files)
+
+
+def files_to_binary_zip(files: "dict[str, bytes]", compresslevel: int = _default_compresslevel) -> bytes:
+    """Builds zip-file out of {path in zip: content}, returns it in byte format. compresslevel 0 stores files as-is"""
+    s = io.BytesIO()
+    compression = zipfile.ZIP_DEFLATED if compresslevel > 0 else zipfile.ZIP_STORED
+    zf = zipfile.ZipFile(file=s, mode="w")
+
+    for fname, content in files.items():
         # Add file, at correct path
-        zf.writestr(data=resp.content, zinfo_or_arcname=fname)
+        zf.writestr(data=content, zinfo_or_arcname=zipfile.ZipInfo(fname, date_time=_zip_date_time),
+                    compress_type=compression, compresslevel=compresslevel or None)
 
     # Must close zip for all contents to be written
     zf.close()
 
-    print("Successfully built zip-file, returning it now")
+    logger.debug("Successfully built zip-file with %d files", len(files))
 
     # Grab ZIP file from in-memory, return
     return s.getvalue()
 
 
+def files_from_binary_zip(zip_data: bytes) -> "dict[str, bytes]":
+    """Returns {path in zip: content} of all files in zip"""
+    with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
+        return {zinfo.filename: zf.read(zinfo) for zinfo in zf.infolist() if not zinfo.is_dir()}
+
+
+def files_to_binary_tar(files: "dict[str, bytes]", fmt: str, compresslevel: int = _default_compresslevel) -> bytes:
+    """Builds tar.gz or tar.xz out of {path in tar: content}, returns it in byte format"""
+    s = io.BytesIO()
+    with tarfile.open(fileobj=s, mode="w", format=tarfile.PAX_FORMAT) as tf:
+        for fname, content in files.items():
+            tinfo = tarfile.TarInfo(fname)  # mtime 0, so the same files always result in the same bytes
+            tinfo.size = len(content)
+            tinfo.mode = 0o644
+            tf.addfile(tinfo, io.BytesIO(content))
+
+    if fmt == 'tar.gz':
+        return compress_parallel(s.getvalue(), lambda block: gzip.compress(block, compresslevel, mtime=0))
+    if fmt == 'tar.xz':
+        preset = min(compresslevel, _max_xz_preset)
+        return compress_parallel(s.getvalue(), lambda block: lzma.compress(block, preset=preset))
+    raise ValueError(f"{fmt} is not a supported tar format")
+
+
+def compress_parallel(data: bytes, compress: "Callable[[bytes], bytes]") -> bytes:
+    """Compresses blocks of data in parallel and concatenates them. \
+        gzip and xz both allow concatenated members/streams, which decompress to the concatenated data"""
+    if len(data) <= _parallel_block_size:
+        return compress(data)
+
+    blocks = [data[i:i + _parallel_block_size] for i in range(0, len(data), _parallel_block_size)]
+    return b''.join(_compress_executor.map(compress, blocks))
+
+
+def repack_binary_zip(zip_data: bytes, fmt: str, compresslevel: int = _default_compresslevel) -> bytes:
+    """Converts zip-file in byte format to fmt (zip, tar.gz or tar.xz) with compresslevel"""
+    files = files_from_binary_zip(zip_data)
+    if fmt == 'zip':
+        return files_to_binary_zip(files, compresslevel)
+    return files_to_binary_tar(files, fmt, compresslevel)
+
+
+def dir_to_binary_zip(dir_path: str) -> bytes:
+    """Zips all files in dir_path, stored under the dir's name like the zips on CTAN, returns it in byte format"""
+    dir_path = os.path.normpath(dir_path)
+    parent = os.path.dirname(dir_path)
+    files = {}
+    for path, subdirs, fnames in os.walk(dir_path, followlinks=True):
+        subdirs.sort()
+        for fname in sorted(fnames):
+            fpath = join(path, fname)
+            with open(fpath, 'rb') as f:
+                files[os.path.relpath(fpath, parent).replace(os.path.sep, '/')] = f.read()
+    return files_to_binary_zip(files)
+
+
 def install_file(file: str):
     path, fname = os.path.split(file)
-    old_cwd = os.getcwd()
-    os.chdir(abspath(path))
-
-    try:
-        if fname.endswith('.ins'):
-            subprocess.run(['latex', fname], stdout=subprocess.DEVNULL, timeout=3)
-        elif fname.endswith('.dtx'):
-            subprocess.run(['tex',   fname], stdout=subprocess.DEVNULL, timeout=2)
-        else:
-            raise ValueError(f"{fname} is not an installable package-file")
-    except:
-        os.chdir(old_cwd)
-        raise
-    os.chdir(old_cwd)
+    # Run in file's dir via cwd instead of os.chdir, which would change cwd of the whole process (e.g. the API)
+    if fname.endswith('.ins'):
+        subprocess.run(['latex', fname], cwd=abspath(path), stdout=subprocess.DEVNULL, timeout=3)
+    elif fname.endswith('.dtx'):
+        subprocess.run(['tex',   fname], cwd=abspath(path), stdout=subprocess.DEVNULL, timeout=2)
+    else:
+        raise ValueError(f"{fname} is not an installable package-file")
 
 
 def extract_version_from_file(fpath: str, pkg_id: str, index: defaultdict, commit_hash: str) -> bool:
@@ -155,7 +253,7 @@ def extract_version_from_file(fpath: str, pkg_id: str, index: defaultdict, commi
                     version_match = re.search(pattern, content)
                     if version_match:
                         version_str = version_str.replace(variable, " " + version_match.group(1) + " ")
-                        logger.debug(f"Substituted {version_match.group(1)} for {variable} in {basename(fpath)}")
+                        logger.debug("Substituted %s for %s in %s", version_match.group(1), variable, fpath)
                 break
 
         if not version_str:
@@ -167,12 +265,12 @@ def extract_version_from_file(fpath: str, pkg_id: str, index: defaultdict, commi
         version = helpers.parse_version(version_str)
 
         index[commit_hash][pkg_id][basename(fpath)] = version
-        print(f"{pkg_id}: {version_str}")
+        logger.debug("%s: %s", pkg_id, version_str)
         return True
 
     except Exception as e:
         index[commit_hash][pkg_id]["Error"] = f"{basename(fpath)}: {e}"
-        print(e)
+        logger.debug("Could not extract version of %s from %s: %s", pkg_id, fpath, e)
         return False
 
 
@@ -181,10 +279,10 @@ def get_relevant_files(subdir: str, pkg: Package, sty_cls=True, ins=True, dtx=Tr
     relevant_files = {'sty/cls': [], 'ins': [], 'dtx': []}
 
     if subdir and os.path.islink(subdir):
-        print(subdir + " is a symlink, resolving now")
+        logger.debug("%s is a symlink, resolving now", subdir)
         # TODO: Check if this works for e.g. a4 or other symlinked packages. See if os.walk finds the files
-        subdir = os.readlink(subdir)
-        print("subdir is now " + subdir)
+        subdir = join(os.path.dirname(subdir), os.readlink(subdir))  # Target is relative to the link's dir
+        logger.debug("subdir is now %s", subdir)
     # Get relevant files in all subdirs. followlinks=True since for some packages, package folder is a symlink, e.g. a4
     for path, subdirs, files in os.walk(subdir, followlinks=True):
         for file in files:
@@ -197,12 +295,37 @@ def get_relevant_files(subdir: str, pkg: Package, sty_cls=True, ins=True, dtx=Tr
     return relevant_files
 
 
+class _DispatchHandler(logging.Handler):
+    """Passes records on to the handlers of the logger they were logged with"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.handlers_by_logger: "dict[str, list[logging.Handler]]" = {}
+
+    def emit(self, record: logging.LogRecord):
+        for handler in self.handlers_by_logger.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+# All loggers put their records in one queue, a background thread writes them to file and stdout
+_log_level = os.environ.get('VPTAN_LOG_LEVEL', 'INFO').upper()
+_log_queue = queue.SimpleQueue()
+_log_dispatcher = _DispatchHandler()
+_log_listener = QueueListener(_log_queue, _log_dispatcher)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Writes remaining records before exiting
+
+
 def make_logger(name: str = "default"):
+    """Logger that writes to stdout (INFO and above) and log/<name>.log (VPTAN_LOG_LEVEL and above). \
+        Records are written by a background thread. Pass arguments separately, e.g. logger.debug("%s", x), \
+        so the message is only built if the level is enabled"""
     logger = logging.getLogger(name)
     if logger.handlers:  # Logger already existed
         return logger
 
-    logger.setLevel(logging.DEBUG)  # Set the desired log level
+    logger.setLevel(_log_level)  # Records below this level are dropped before they are built
     logger.propagate = 0
 
     # Logging to stdout
@@ -222,9 +345,10 @@ def make_logger(name: str = "default"):
     fh.setFormatter(formatter)
     stream_handler.setFormatter(formatter)
 
-    # Add the handler to the logger
-    logger.addHandler(fh)
-    logger.addHandler(stream_handler)
+    # Add the handlers to the background thread, the logger only puts records in the queue
+    _log_dispatcher.handlers_by_logger[name] = [fh, stream_handler]
+    # QueueHandler builds the message before queueing, so arguments that change later are logged as they were
+    logger.addHandler(QueueHandler(_log_queue))
 
     return logger
 
@@ -0,0 +1,90 @@
+import cProfile
+import datetime
+import io
+import os
+from os.path import join
+import pstats
+import re
+import time
+from typing import Optional
+
+from app.helpers import helpers
+
+logger = helpers.make_logger('profiling')
+
+# Profile every /packages request (single requests can also ask for it, see dependencies.py),
+# and indexing of the commit with this hash (can also be given when triggering an update, see IndexService.py)
+profile_requests = os.environ.get('VPTAN_PROFILE', '') == '1'
+profile_index_commit = os.environ.get('VPTAN_PROFILE_INDEX') or None
+profile_dir = os.environ.get('VPTAN_PROFILE_DIR', 'log/profiles')
+
+# Functions whose cumulative time is time spent waiting on something else: (end of file path, function name)
+_wait_functions = {
+    'upstream': [('requests/sessions.py', 'send')],
+    'subprocess': [('subprocess.py', 'run'), ('subprocess.py', 'call')],
+}
+
+
+class Profile:
+    """Deterministic profile of everything run in the current thread within the with-block. \
+        Saves the profile (.prof, for pstats/snakeviz) and a summary (.txt) to profile_dir. \
+        If started (a time.perf_counter()) is given, wall time counts from then, \
+        and the time before the with-block is reported as 'before'"""
+
+    def __init__(self, name: str, started: Optional[float] = None) -> None:
+        self.name = re.sub(r'[^\w.-]', '_', name)
+        self.started = started
+        self.wall = self.cpu = self.before = 0.0
+        self.waits = {}
+        self.file_name = None
+        self._profiler = cProfile.Profile()
+
+    def __enter__(self) -> "Profile":
+        self._wall_start, self._cpu_start = time.perf_counter(), time.thread_time()
+        self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler.disable()
+        if self.started is not None:
+            self.before = self._wall_start - self.started
+        self.wall = time.perf_counter() - (self._wall_start if self.started is None else self.started)
+        self.cpu = time.thread_time() - self._cpu_start
+
+        stats = pstats.Stats(self._profiler)
+        self.waits = {kind: _cumulative_time(stats, functions) for kind, functions in _wait_functions.items()}
+        try:
+            self._save(stats)
+        except OSError as e:
+            logger.warning("Could not save profile %s: %s", self.name, e)
+        return False
+
+    def server_timing(self) -> str:
+        """Timings in the format of the Server-Timing header"""
+        timings = {'total': self.wall, **({'before': self.before} if self.started is not None else {}),
+                   'cpu': self.cpu, **self.waits}
+        return ', '.join(f"{kind};dur={duration * 1000:.1f}" for kind, duration in timings.items())
+
+    def _save(self, stats: pstats.Stats):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.file_name = f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{self.name}"
+        stats.dump_stats(join(profile_dir, self.file_name + '.prof'))
+
+        summary = io.StringIO()
+        summary.write(f"{self.name}: wall {self.wall:.3f}s (before profile {self.before:.3f}s), cpu {self.cpu:.3f}s, "
+                      + ', '.join(f"{kind} {duration:.3f}s" for kind, duration in self.waits.items()) + '\n\n')
+        stats.stream = summary
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(40)
+        stats.print_callees(20)
+        with open(join(profile_dir, self.file_name + '.txt'), 'w') as f:
+            f.write(summary.getvalue())
+        logger.info("Saved profile of %s to %s.prof/.txt", self.name, join(profile_dir, self.file_name))
+
+
+def _cumulative_time(stats: pstats.Stats, functions: "list[tuple[str, str]]") -> float:
+    return sum(
+        cumulative
+        for (path, _, func_name), (_, _, _, cumulative, _) in stats.stats.items()
+        for path_end, name in functions
+        if func_name == name and path.replace(os.path.sep, '/').endswith(path_end)
+    )
@@ -1,11 +1,18 @@
 from fastapi import FastAPI
 import uvicorn
 
-from app.routers import packages, alias
+from app.routers import packages, alias, admin
+from app.services import IndexService
 
 app = FastAPI()
 app.include_router(packages.router)
 app.include_router(alias.router)
+app.include_router(admin.router)
+
+
+@app.on_event("startup")
+def start_index_schedule():
+    IndexService.start_schedule()
 
 
 @app.get("/", tags=['home'])
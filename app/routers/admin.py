@@ -0,0 +1,28 @@
+from typing import Union
+
+from fastapi import APIRouter, Depends, status
+
+from app.services import IndexService
+from ..dependencies import admin_authorized
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(admin_authorized)],
+    responses={403: {"description": "Missing or invalid X-Admin-Token"}},
+)
+
+
+@router.get("/index")
+def get_index_status():
+    return IndexService.status()
+
+
+@router.post("/index", status_code=status.HTTP_202_ACCEPTED)
+def trigger_index_update(profile: Union[str, None] = None):
+    """Starts an index update. profile: Hash of a commit whose indexing should be profiled"""
+    started = IndexService.trigger(profile)
+    return {
+        'message': "Started index update" if started else "Index update is already running",
+        'status': IndexService.status()
+    }
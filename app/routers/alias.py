@@ -7,7 +7,7 @@ from os.path import isfile, abspath
 
 logger = helpers.make_logger('api_alias')
 aliases_file = 'CTAN_aliases.json'
-_ctan_url = "https://www.ctan.org/"
+_ctan_url = helpers.ctan_url + "/"
 
 router = APIRouter(
     prefix="/alias",
@@ -28,7 +28,7 @@ def get_alias_of_package(id='', name='') -> dict:
         where they are listed as 'aliases'
         Example: tikz is not available on CTAN as package, but is listed in alias field of pgf.\
         Therefore, we should download pgf to get tikz"""
-    logger.info(f'Searching for {id if id else name} in aliases')
+    logger.info('Searching for %s in aliases', id if id else name)
 
     found = False
 
@@ -44,7 +44,7 @@ def get_alias_of_package(id='', name='') -> dict:
                     break
 
     if not found:
-        logger.info(f"Couldn't find {id if id else name} in list of aliases")
+        logger.info("Couldn't find %s in list of aliases", id if id else name)
 
         # TODO: Reactivate this once update_alias terminates if last call was too recent
         # background_thread = threading.Thread(target=update_aliases)
@@ -79,7 +79,8 @@ def update_aliases() -> bool:
                                 }
                         })
                 except Exception as e:
-                    logger.warning(f'Something went wrong while extracting alias for {pkgInfo["id"]}, alias = {pkgInfo["aliases"]}: {str(e)}')  # noqa: E501
+                    logger.warning('Something went wrong while extracting alias for %s, alias = %s: %s',
+                                   pkgInfo["id"], pkgInfo["aliases"], e)
         except ValueError as e:
             print(e)
 
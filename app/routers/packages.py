@@ -1,11 +1,13 @@
 from datetime import date
-from typing import Union
-from fastapi import APIRouter, Depends, Response, HTTPException
-from app.helpers import helpers
+import hashlib
+from typing import Literal, Optional, Union
+import zipfile
+from fastapi import APIRouter, Depends, Query, Request, Response, HTTPException
+from app.helpers import helpers, profiling
 
-from app.services import ArchiveService
+from app.services import ArchiveService, CacheService
 from app.archives import CTAN
-from ..dependencies import pkg_id_exists, valid_date
+from ..dependencies import pkg_id_exists, profiling_requested, valid_date
 from app.schemas import Package, Version
 
 router = APIRouter(
@@ -23,23 +25,191 @@ def getAllPackages():
 logger = helpers.make_logger('api_get_packages')
 
 
+# Historical downloads are pinned to a commit hash and never change, latest ones can change any time
+_revalidate_max_age = 300
+_immutable_cache_control = "public, max-age=31536000, immutable"
+_revalidate_cache_control = f"public, max-age={_revalidate_max_age}, must-revalidate"
+
+# Supported archive formats and their media type
+_media_types = {
+    'zip': "application/x-zip-compressed",
+    'tar.gz': "application/gzip",
+    'tar.xz': "application/x-xz",
+}
+_formats_by_media_type = {
+    "application/zip": 'zip',
+    "application/x-zip-compressed": 'zip',
+    "application/gzip": 'tar.gz',
+    "application/x-gzip": 'tar.gz',
+    "application/x-xz": 'tar.xz',
+}
+
+
 @router.get("/{pkg_id}")
-def get_package(ctan_pkg: Package = Depends(pkg_id_exists), date: Union[date, None] = Depends(valid_date),
-                number: Union[str, None] = None, closest: Union[bool, None] = None):
+def get_package(request: Request, profile_started: Optional[float] = Depends(profiling_requested),
+                ctan_pkg: Package = Depends(pkg_id_exists),
+                date: Union[date, None] = Depends(valid_date),
+                number: Union[str, None] = None, closest: Union[bool, None] = None,
+                fmt: Union[Literal['zip', 'tar.gz', 'tar.xz'], None] = Query(default=None, alias='format'),
+                level: Union[int, None] = Query(default=None, ge=0, le=9)):
+    if profile_started is None:
+        return _get_package(request, ctan_pkg, date, number, closest, fmt, level)
+
+    # Dependencies (pkg_id_exists' request to CTAN) ran before the profile, they are only in total and 'before'
+    with profiling.Profile(f"get_package-{ctan_pkg.id}", started=profile_started) as prof:
+        response = _get_package(request, ctan_pkg, date, number, closest, fmt, level)
+    response.headers['Server-Timing'] = prof.server_timing()
+    if prof.file_name:
+        response.headers['X-Profile'] = prof.file_name
+    return response
+
+
+def _get_package(request: Request, ctan_pkg: Package, date: Optional[date], number: Optional[str],
+                 closest: Optional[bool], fmt: Optional[str], level: Optional[int]) -> Response:
     req_version = Version(number=number, date=date)
-    logger.info(f"/pkg_id called with {ctan_pkg.id} in version {req_version}")
+    logger.info("/pkg_id called with %s in version %s", ctan_pkg.id, req_version)
+
+    fmt = fmt or negotiate_format(request.headers.get('accept'))
+    variant = f"{fmt}:{level}"
 
     # If version = latest or requested version equal to version on CTAN: Download from CTAN
     if check_satisfying(ctan_pkg.version, req_version):
-        byte_data = CTAN.download_pkg(ctan_pkg)
+        # Latest version can change on CTAN without a new version number, and comes from any mirror.
+        # So the ETag comes from the bytes we serve. It is remembered for as long as clients may cache the download,
+        # so revalidating and downloading again within that time doesn't go to a mirror
+        latest_key = make_latest_key(ctan_pkg, variant)
+        etag = CacheService.get_latest(latest_key)
+        byte_data = CacheService.get(etag) if etag else None
+        if etag is None or (byte_data is None and not etag_matches(request.headers.get('if-none-match'), etag)):
+            byte_data = pack(CTAN.download_pkg(ctan_pkg), fmt, level)
+            etag = f'"{hashlib.sha1(byte_data).hexdigest()}"'
+            CacheService.put_latest(latest_key, etag, _revalidate_max_age)
+            CacheService.put(etag, byte_data)
+
+        headers = {'ETag': etag, 'Cache-Control': _revalidate_cache_control, 'Vary': 'Accept'}
+        if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+            return Response(status_code=304, headers=headers)
     else:
-        try:
-            ctan_pkg.version = req_version
-            byte_data = ArchiveService.download_pkg(ctan_pkg, closest)
-        except HTTPException:
-            raise
+        ctan_pkg.version = req_version
+        commit_hash = ArchiveService.get_commit_hash(ctan_pkg, closest)
+        headers = {
+            'ETag': make_etag(ctan_pkg.id, commit_hash, ctan_pkg.ctan.path if ctan_pkg.ctan else '', variant),
+            # With closest, a closer commit can be added to the index later
+            'Cache-Control': _revalidate_cache_control if closest else _immutable_cache_control,
+            'Vary': 'Accept',  # Format can come from Accept. Also needed on 304, so caches pick the right variant
+        }
+        if etag_matches(request.headers.get('if-none-match'), headers['ETag']):
+            return Response(status_code=304, headers=headers)
+
+        # Files at a commit hash never change, so the packed archive can be reused as-is
+        byte_data = CacheService.get(headers['ETag'])
+        if byte_data is None:
+            byte_data = pack(ArchiveService.download_pkg(ctan_pkg, closest, commit_hash), fmt, level)
+            CacheService.put(headers['ETag'], byte_data)
+
+    headers['Content-Disposition'] = f'attachment; filename="{ctan_pkg.id}.{fmt}"'
+    return make_download_response(request, byte_data, headers, _media_types[fmt])
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+    """Returns supported archive format with the highest q-value in Accept header (first one if tied), \
+        zip if there is none"""
+    candidates = []
+    for media_range in (accept or '').split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        if media_type.lower() not in _formats_by_media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0  # Invalid media range, ignore it
+        if q > 0:
+            candidates.append((q, _formats_by_media_type[media_type.lower()]))
+
+    # sorted() is stable, so equally preferred formats stay in the order of the header
+    return sorted(candidates, key=lambda candidate: -candidate[0])[0][1] if candidates else 'zip'
+
+
+def pack(zip_data: bytes, fmt: str, level: Optional[int]) -> bytes:
+    """Converts zip-file from an archive to fmt. Zips are passed on as they are, unless a level is requested"""
+    if level is None and fmt == 'zip':
+        return zip_data
+    try:
+        if level is None:
+            return helpers.repack_binary_zip(zip_data, fmt)
+        return helpers.repack_binary_zip(zip_data, fmt, level)
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=502, detail="Upstream did not return a valid zip-file")
+
+
+def make_etag(pkg_id: str, commit_hash: str, path: str, variant: str = '') -> str:
+    """Strong ETag for the archive (in format/compression variant) of pkg_id's files at path \
+        in the archive at commit_hash"""
+    digest = hashlib.sha1(f"{pkg_id}\0{commit_hash}\0{path}\0{variant}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def make_latest_key(pkg: Package, variant: str) -> str:
+    """Key under which the ETag of pkg's latest version (in format/compression variant) is remembered"""
+    path = pkg.install or (pkg.ctan.path if pkg.ctan else '')
+    version = f"{pkg.version.number}\0{pkg.version.date}" if pkg.version else ''
+    return f"{pkg.id}\0{version}\0{path}\0{variant}"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Checks If-None-Match header against etag (weak comparison, as per RFC 9110)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+def make_download_response(request: Request, byte_data: bytes, headers: dict, media_type: str) -> Response:
+    """Returns byte_data, or the requested part of it if request has a valid Range header"""
+    headers = {**headers, 'Accept-Ranges': 'bytes'}
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+
+    # If-Range with a stale ETag means client gets the whole file
+    if range_header and (not if_range or if_range.strip() == headers['ETag']):
+        byte_range = parse_range(range_header, len(byte_data))
+        if byte_range:
+            start, end = byte_range
+            headers['Content-Range'] = f"bytes {start}-{end}/{len(byte_data)}"
+            return Response(byte_data[start:end + 1], status_code=206, headers=headers, media_type=media_type)
+
+    return Response(byte_data, headers=headers, media_type=media_type)
+
+
+def parse_range(range_header: str, size: int) -> Optional["tuple[int, int]"]:
+    """Returns (start, end) of a single byte-range, both inclusive. \
+        None if the range can't be served as one part, in which case the whole file should be sent"""
+    unit, _, range_spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in range_spec:
+        return None
+
+    start, _, end = range_spec.strip().partition('-')
+    try:
+        if not start:  # Suffix range, e.g. bytes=-500 for the last 500 bytes
+            length = int(end)
+            start, end = max(size - length, 0), size - 1
+            if length == 0:
+                start = size
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
 
-    return Response(byte_data, media_type="application/x-zip-compressed")
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail=f"Cannot satisfy range {range_header}",
+                            headers={'Content-Range': f"bytes */{size}"})
+    return start, end
 
 
 def check_satisfying(ctan_version: Version, req_version: Version):
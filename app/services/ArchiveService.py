@@ -1,4 +1,6 @@
 import logging
+import os
+from typing import Optional
 
 from fastapi import HTTPException
 from app.archives.CTAN_historical_git import CTAN_historical_git
@@ -7,12 +9,21 @@ from app.schemas import Package
 
 logger = logging.getLogger("default")
 
-CTAN_hist = CTAN_historical_git()
+CTAN_hist = CTAN_historical_git(os.environ.get('VPTAN_CTAN_ARCHIVE_PATH', 'CTAN'))
 
 
-def download_pkg(pkg: Package, closest: bool):
+def get_commit_hash(pkg: Package, closest: bool) -> str:
+    """Returns the commit hash under which pkg is available in the requested version"""
+    commit_hash = CTAN_hist.get_commit_hash(pkg, closest)
+    if commit_hash:
+        return commit_hash
+
+    raise HTTPException(status_code=404, detail=f"{pkg.name} is not available in version {pkg.version} on VPTAN")
+
+
+def download_pkg(pkg: Package, closest: bool, commit_hash: Optional[str] = None):
     """Checks supported package-archives for requested package, returns zipfile of package's files"""
-    res = CTAN_hist.get_pkg_files(pkg, closest)
+    res = CTAN_hist.get_pkg_files(pkg, closest, commit_hash)
     if res:
         return res
 
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+from typing import Optional
+
+# Built archives of immutable downloads, by ETag. Least recently used ones are evicted first
+_max_bytes = int(float(os.environ.get('VPTAN_ARTIFACT_CACHE_MB', 256)) * 1024 * 1024)
+_artifacts: "OrderedDict[str, bytes]" = OrderedDict()
+_size = 0
+_lock = threading.Lock()
+
+# ETags of latest-version downloads, by package, version, path and variant, until they expire.
+# All entries live equally long, so the oldest ones are at the front
+_latest: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+
+
+def get(key: str) -> Optional[bytes]:
+    with _lock:
+        data = _artifacts.get(key)
+        if data is not None:
+            _artifacts.move_to_end(key)
+        return data
+
+
+def put(key: str, data: bytes):
+    global _size
+    if len(data) > _max_bytes:
+        return
+
+    with _lock:
+        if key in _artifacts:
+            _size -= len(_artifacts.pop(key))
+        _artifacts[key] = data
+        _size += len(data)
+        while _size > _max_bytes:
+            _, evicted = _artifacts.popitem(last=False)
+            _size -= len(evicted)
+
+
+def get_latest(key: str) -> Optional[str]:
+    """ETag remembered for key, if it hasn't expired yet"""
+    with _lock:
+        entry = _latest.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+
+def put_latest(key: str, etag: str, max_age: float):
+    """Remembers etag for key during max_age seconds"""
+    now = time.monotonic()
+    with _lock:
+        _latest.pop(key, None)
+        _latest[key] = (etag, now + max_age)
+        while _latest and next(iter(_latest.values()))[1] <= now:
+            _latest.popitem(last=False)
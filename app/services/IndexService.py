@@ -0,0 +1,84 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from app.helpers import helpers, profiling
+from app.services.ArchiveService import CTAN_hist
+
+logger = helpers.make_logger('CTANArchive')
+
+# Seconds between scheduled index updates. 0 means index is only updated when triggered
+_interval = float(os.environ.get('VPTAN_INDEX_INTERVAL', 0))
+
+_lock = threading.Lock()  # Held while an update is running
+_schedule_thread: Optional[threading.Thread] = None
+_status = {
+    'running': False,
+    'generation': 0,  # Number of index generations this process published since start
+    'last_started': None,
+    'last_finished': None,
+    'last_added': None,  # Number of commits added by last update
+    'last_error': None,
+    'interval': _interval,
+}
+
+
+def status() -> dict:
+    """Returns state of the indexer"""
+    return dict(_status)
+
+
+def trigger(profile_commit: Optional[str] = None) -> bool:
+    """Starts an index update in the background. Returns False if one is already running. \
+        If profile_commit is given, indexing that commit is profiled (default: VPTAN_PROFILE_INDEX)"""
+    if not _lock.acquire(blocking=False):
+        return False
+    threading.Thread(target=_run_locked, args=(profile_commit or profiling.profile_index_commit,),
+                     name='indexer', daemon=True).start()
+    return True
+
+
+def start_schedule():
+    """Updates index every VPTAN_INDEX_INTERVAL seconds in a background thread. \
+        With several API workers, each one runs a schedule. Updates lock each other out across processes, \
+        and the other workers pick up the published index from the index file"""
+    global _schedule_thread
+    if _schedule_thread or _interval <= 0:
+        return
+
+    def run_forever():
+        while True:
+            time.sleep(_interval)
+            if not trigger():
+                logger.info("Scheduled index update skipped, another one is still running")
+
+    _schedule_thread = threading.Thread(target=run_forever, name='index-schedule', daemon=True)
+    _schedule_thread.start()
+    logger.info("Updating index every %s seconds", _interval)
+
+
+def _run_locked(profile_commit: Optional[str] = None):
+    """Runs one index update. _lock must be held by caller, is released when done"""
+    try:
+        _status.update(running=True, last_started=_now(), last_error=None)
+        result = CTAN_hist.update_index(profile_commit=profile_commit)
+        _status['last_added'] = result['added']
+        if result['published']:
+            _status['generation'] += 1
+        if result['failed_commits']:
+            _status['last_error'] = f"Indexing failed at {len(result['failed_commits'])} commits: " \
+                                    f"{result['failed_commits']}"
+    except Exception as e:
+        _status['last_error'] = str(e)
+        logger.error("Index update failed: %s", e)
+        logging.exception(e)
+    finally:
+        _status.update(running=False, last_finished=_now())
+        _lock.release()
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec='seconds')
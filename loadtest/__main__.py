@@ -0,0 +1,267 @@
+"""Load test for VPTAN against local stand-ins for ctan.org, its mirrors and git.texlive.info
+
+Usage: python -m loadtest [--concurrency 16] [--requests 1000] [--mix-file mix.jsonl] ...
+Run from the root of the repository, see python -m loadtest --help for all options.
+"""
+import argparse
+from collections import Counter, defaultdict
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists
+
+import requests
+
+from loadtest.fake_upstream import FakeUpstream
+
+
+def make_mix(n: int, weights: "dict[str, float]", seed: int, pkg_info_file: str, index_file: str,
+             aliases_file: str, variants: float = 0.0, revalidate: float = 0.0) -> "list[dict]":
+    """Draws n requests from the package catalogue. Kinds: latest, historical and alias. \
+        A share of package downloads asks for another format/compression level (variants), \
+        and a share revalidates with If-None-Match (revalidate)"""
+    rnd = random.Random(seed)
+    with open(pkg_info_file, 'r', encoding='utf-8') as f:
+        pkg_infos = json.load(f)
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+    with open(aliases_file, 'r') as f:
+        aliases = json.load(f)
+
+    candidates = {
+        'latest': [f"/packages/{pkg['id']}" for pkg in pkg_infos if pkg['ctan'] or pkg['install']],
+        # Versions that are in the index, so they can be found without closest
+        'historical': sorted({
+            f"/packages/{pkg_id}?date={version['date']}"
+            for pkgs in index.values() if pkgs
+            for pkg_id, files in pkgs.items() if files and 'Error' not in files
+            for version in files.values() if version and version.get('date')
+        }),
+        'alias': [f"/alias/?id={alias['id']}" for alias in aliases],
+    }
+    kinds = [kind for kind in weights if weights[kind] > 0 and candidates[kind]]
+    mix = []
+    downloads = []  # Earlier package downloads, which revalidations repeat
+    for kind in rnd.choices(kinds, weights=[weights[kind] for kind in kinds], k=n):
+        if kind != 'alias' and downloads and rnd.random() < revalidate:
+            mix.append({**rnd.choice(downloads), 'revalidate': True})
+            continue
+
+        req = {'kind': kind, 'path': rnd.choice(candidates[kind])}
+        if kind != 'alias':
+            if rnd.random() < variants:
+                fmt = rnd.choice(['zip', 'tar.gz', 'tar.xz'])
+                req['path'] += f"{'&' if '?' in req['path'] else '?'}format={fmt}&level={rnd.randint(0, 9)}"
+            downloads.append(req)
+        mix.append(req)
+    return mix
+
+
+def run_load(target: str, mix: "list[dict]", concurrency: int, duration: float = None, timeout: float = 60) -> dict:
+    """Sends requests of mix to target with concurrency parallel clients. \
+        If duration is given, mix is repeated until duration seconds have passed"""
+    requests_iter = itertools.cycle(mix) if duration else iter(mix)
+    iter_lock = threading.Lock()
+    results = defaultdict(lambda: {'latencies': [], 'statuses': Counter()})
+    results_lock = threading.Lock()
+    etags = {}  # Last ETag seen per path, for revalidating requests
+    start = time.monotonic()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with iter_lock:
+                req = next(requests_iter, None)
+            if req is None or (duration and time.monotonic() - start > duration):
+                return
+
+            # Revalidations are counted separately, and as normal requests until an ETag for the path is known
+            kind, headers = req['kind'], {}
+            if req.get('revalidate') and req['path'] in etags:
+                kind, headers = f"{kind}/304", {'If-None-Match': etags[req['path']]}
+
+            req_start = time.monotonic()
+            try:
+                response = session.get(target + req['path'], headers=headers, timeout=timeout)
+                status = response.status_code
+                if 'ETag' in response.headers:
+                    etags[req['path']] = response.headers['ETag']
+            except requests.RequestException as e:
+                status = type(e).__name__
+            latency = time.monotonic() - req_start
+
+            with results_lock:
+                results[kind]['latencies'].append(latency)
+                results[kind]['statuses'][status] += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+
+    return {'elapsed': time.monotonic() - start, 'results': dict(results)}
+
+
+def percentile(sorted_values: "list[float]", p: float) -> float:
+    """Nearest-rank percentile"""
+    return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+def summarize(run: dict) -> dict:
+    summary = {'elapsed_s': round(run['elapsed'], 3), 'kinds': {}}
+    all_latencies, all_errors = [], 0
+    for kind, result in sorted(run['results'].items()):
+        latencies = sorted(result['latencies'])
+        errors = sum(count for status, count in result['statuses'].items() if not _is_success(status))
+        all_latencies.extend(latencies)
+        all_errors += errors
+        summary['kinds'][kind] = _stats(latencies, errors, run['elapsed'])
+        summary['kinds'][kind]['statuses'] = {str(status): count for status, count in result['statuses'].items()}
+    summary['total'] = _stats(sorted(all_latencies), all_errors, run['elapsed'])
+    return summary
+
+
+def print_summary(summary: dict):
+    print(f"{'kind':<16}{'requests':>10}{'req/s':>10}{'errors':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for kind, stats in [*summary['kinds'].items(), ('total', summary['total'])]:
+        if not stats['requests']:
+            continue
+        print(f"{kind:<16}{stats['requests']:>10}{stats['throughput']:>10.1f}{stats['error_rate']:>8.1%} "
+              f"{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    for kind, stats in summary['kinds'].items():
+        print(f"{kind} statuses: {stats['statuses']}")
+
+
+def start_vptan(upstream: FakeUpstream, workers: int, log_file: str) -> "tuple[subprocess.Popen, str]":
+    """Starts VPTAN with uvicorn, configured to use upstream. Returns process and its url"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    env = {
+        **os.environ,
+        'VPTAN_CTAN_URL': upstream.url,
+        'VPTAN_CTAN_ARCHIVE_URL': upstream.url + '/CTAN',
+        'VPTAN_CTAN_MIRRORS': upstream.url + '/mirror',
+        'VPTAN_MIRROR_PROBE_INTERVAL': '0',
+        'VPTAN_INDEX_INTERVAL': '0',
+    }
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'app.main:app', '--host', '127.0.0.1', '--port', str(port),
+             '--workers', str(workers), '--log-level', 'warning'],
+            env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"VPTAN exited with code {process.returncode}, see {log_file}")
+        try:
+            if requests.get(url + '/', timeout=1).ok:
+                return process, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"VPTAN did not start within 60 seconds, see {log_file}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m loadtest', description=__doc__.splitlines()[0])
+    parser.add_argument('--target',
+                        help="URL of a running VPTAN. If not given, VPTAN is started against fake upstreams")
+    parser.add_argument('--concurrency', type=int, default=16, help="Number of parallel clients")
+    parser.add_argument('--requests', type=int, default=1000, help="Number of requests in a generated mix")
+    parser.add_argument('--duration', type=float, help="Repeat the mix for this many seconds instead of once")
+    parser.add_argument('--mix-file', help="Replay requests from this JSON-lines file. Generated and saved if missing")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for generating the mix")
+    parser.add_argument('--latest', type=float, default=0.6, help="Share of downloads of the latest version")
+    parser.add_argument('--historical', type=float, default=0.3, help="Share of downloads of historical versions")
+    parser.add_argument('--alias', type=float, default=0.1, help="Share of /alias requests")
+    parser.add_argument('--variants', type=float, default=0.2,
+                        help="Share of downloads with a random format and compression level")
+    parser.add_argument('--revalidate', type=float, default=0.2,
+                        help="Share of downloads that revalidate with If-None-Match")
+    parser.add_argument('--latency-ms', type=float, default=50, help="Latency of fake upstreams")
+    parser.add_argument('--jitter-ms', type=float, default=20, help="Random extra latency of fake upstreams")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of fake upstream responses that are 503")
+    parser.add_argument('--file-kb', type=int, default=20, help="Size of files served by fake upstreams")
+    parser.add_argument('--workers', type=int, default=1, help="Number of uvicorn workers when starting VPTAN")
+    parser.add_argument('--output', help="Also write the report as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pkg_info_file, index_file, aliases_file = "CTAN_packages.json", "CTAN_Archive_index.json", "CTAN_aliases.json"
+
+    if args.mix_file and exists(args.mix_file):
+        with open(args.mix_file, 'r') as f:
+            mix = [json.loads(line) for line in f if line.strip()]
+        print(f"Replaying {len(mix)} requests from {args.mix_file}")
+    else:
+        weights = {'latest': args.latest, 'historical': args.historical, 'alias': args.alias}
+        mix = make_mix(args.requests, weights, args.seed, pkg_info_file, index_file, aliases_file,
+                       args.variants, args.revalidate)
+        if args.mix_file:
+            with open(args.mix_file, 'w') as f:
+                f.writelines(json.dumps(req) + '\n' for req in mix)
+            print(f"Saved {len(mix)} requests to {args.mix_file}")
+
+    upstream, process = None, None
+    target = args.target
+    try:
+        if not target:
+            upstream = FakeUpstream(pkg_info_file, index_file, latency=args.latency_ms / 1000,
+                                    jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+                                    file_size=args.file_kb * 1024)
+            upstream.start()
+            process, target = start_vptan(upstream, args.workers, 'log/loadtest_vptan.log')
+            print(f"Fake upstreams at {upstream.url}, VPTAN at {target}")
+
+        print(f"Sending {'requests for ' + str(args.duration) + 's' if args.duration else str(len(mix)) + ' requests'} "
+              f"with concurrency {args.concurrency}")
+        summary = summarize(run_load(target.rstrip('/'), mix, args.concurrency, args.duration))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+        if upstream:
+            upstream.stop()
+
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+def _is_success(status) -> bool:
+    return isinstance(status, int) and (200 <= status < 300 or status == 304)
+
+
+def _stats(sorted_latencies: "list[float]", errors: int, elapsed: float) -> dict:
+    n = len(sorted_latencies)
+    if not n:
+        return {'requests': 0}
+    return {
+        'requests': n,
+        'throughput': n / elapsed,
+        'error_rate': errors / n,
+        'p50_ms': percentile(sorted_latencies, 50) * 1000,
+        'p90_ms': percentile(sorted_latencies, 90) * 1000,
+        'p99_ms': percentile(sorted_latencies, 99) * 1000,
+        'max_ms': sorted_latencies[-1] * 1000,
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Local stand-in for ctan.org, its mirrors and git.texlive.info
+
+Serves, under one address:
+- /json/2.0/packages and /json/2.0/pkg/{pkg_id}: CTAN's JSON API, from CTAN_packages.json
+- /CTAN/plain/{path}?id={hash}: Directory listings and files of the historical git archive
+- /mirror/{path}: Files, zipped directories and install zips (/install/...tds.zip) of a CTAN mirror
+
+File names come from CTAN_Archive_index.json, contents are generated.
+"""
+from collections import defaultdict
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from app.helpers import helpers
+
+
+class FakeUpstream:
+    def __init__(self, pkg_info_file: str = "CTAN_packages.json", index_file: str = "CTAN_Archive_index.json",
+                 latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0, file_size: int = 20 * 1024,
+                 host: str = "127.0.0.1", port: int = 0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.file_size = file_size
+
+        with open(pkg_info_file, 'r', encoding='utf-8') as f:
+            self.pkg_infos = {pkg['id']: pkg for pkg in json.load(f)}
+        with open(index_file, 'r') as f:
+            self.index = json.load(f)
+        self.pkgs_by_path = defaultdict(list)
+        for pkg in self.pkg_infos.values():
+            if pkg.get('ctan') and pkg['ctan'].get('path'):
+                self.pkgs_by_path[pkg['ctan']['path'].rstrip('/')].append(pkg)
+
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-upstream', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def file_names(self, path: str, commit_hash: str = None) -> "list[str]":
+        """Names of files in package dir at path, as recorded in the index at commit_hash"""
+        names = set()
+        for pkg in self.pkgs_by_path.get(path, []):
+            files = (self.index.get(commit_hash) or {}).get(pkg['id']) or {}
+            names.update(fname for fname in files if fname != 'Error')
+            if not files or 'Error' in files:
+                names.add(f"{pkg['id']}.sty")
+        return sorted(names) + ['README']
+
+    @lru_cache(maxsize=4096)
+    def file_content(self, path: str) -> bytes:
+        """Deterministic TeX-like content of self.file_size bytes"""
+        name = path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        line = f"\\ProvidesPackage{{{name}}}[2020/01/01 v1.0 {name}]\n".encode()
+        filler = b''.join(f"\\def\\{name}@{i}{{{i * 7919 % 10007}}}\n".encode() for i in range(64))
+        return (line + filler * (self.file_size // len(filler) + 1))[:self.file_size]
+
+    @lru_cache(maxsize=1024)
+    def zip_content(self, path: str) -> bytes:
+        """Zip of a package dir (path is ctan path + .zip), or TDS-like install zip for any other zip path"""
+        dir_path = path[:-len('.zip')]
+        if dir_path in self.pkgs_by_path:
+            dir_name = dir_path.rsplit('/', 1)[-1]
+            files = {f"{dir_name}/{fname}": self.file_content(f"{dir_path}/{fname}")
+                     for fname in self.file_names(dir_path)}
+        else:
+            # e.g. /install/macros/latex/required/amsmath.tds.zip
+            name = path.rsplit('/', 1)[-1].split('.')[0]
+            files = {f"tex/latex/{name}/{name}.sty": self.file_content(f"{name}.sty"),
+                     f"doc/latex/{name}/README": self.file_content(f"{name}/README")}
+        return helpers.files_to_binary_zip(files)
+
+    def _make_handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(upstream.latency + random.uniform(0, upstream.jitter))
+                if random.random() < upstream.error_rate:
+                    return self._send(503, b"Injected error", "text/plain")
+
+                url = urlparse(self.path)
+                path = url.path.rstrip('/')
+                if path == '/json/2.0/packages':
+                    body = [{'key': pkg['id'], 'name': pkg['name']} for pkg in upstream.pkg_infos.values()]
+                    return self._send_json(body)
+                if path.startswith('/json/2.0/pkg/'):
+                    pkg = upstream.pkg_infos.get(path[len('/json/2.0/pkg/'):])
+                    return self._send_json(pkg) if pkg else self._send_json({'errors': ['not found']}, 404)
+                if path.startswith('/CTAN/plain/'):
+                    commit_hash = parse_qs(url.query).get('id', [None])[0]
+                    return self._archive(path[len('/CTAN/plain'):], commit_hash)
+                if path.startswith('/mirror/'):
+                    return self._mirror(path[len('/mirror'):])
+                self._send(404, b"Not found", "text/plain")
+
+            do_HEAD = do_GET
+
+            def _archive(self, path: str, commit_hash: str):
+                if path in upstream.pkgs_by_path and '.' not in path.rsplit('/', 1)[-1]:
+                    links = ['<li><a href="../">../</a></li>'] + [
+                        f'<li><a href="/CTAN/plain{path}/{fname}?id={commit_hash}">{fname}</a></li>'
+                        for fname in upstream.file_names(path, commit_hash)
+                    ]
+                    html = f"<html><body><ul>{''.join(links)}</ul></body></html>"
+                    return self._send(200, html.encode(), "text/html")
+                self._send(200, upstream.file_content(path), "text/plain")
+
+            def _mirror(self, path: str):
+                if path.endswith('.zip'):
+                    return self._send(200, upstream.zip_content(path), "application/zip")
+                self._send(200, upstream.file_content(path), "application/octet-stream")
+
+            def _send_json(self, body, status: int = 200):
+                self._send(status, json.dumps(body).encode(), "application/json")
+
+            def _send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler